@@ -0,0 +1,97 @@
+"""Test setup.
+
+The cache is built on ``dbm.gnu`` which needs Python to have been compiled against
+GNU dbm. Where it hasn't been, a small fake ``_gdbm`` is installed before the cache is
+imported so the worker, batching and expiry logic is still exercised. The fake keeps
+its data in the database file, rewritten whenever a writer syncs or closes, and
+enforces gdbm's locking: one writer or any number of readers per file.
+"""
+import builtins
+import errno
+import os
+import pickle
+import sys
+import types
+
+_LOCKS: dict[str, int] = {}  # path -> -1 for a writer, else the number of readers
+
+
+class _FakeError(OSError):
+    pass
+
+
+class _FakeDb:
+    def __init__(self, path: str, flag: str = "r", mode: int = 0o666):
+        self._path = path
+        self._writer = not flag.startswith("r")
+        if not os.path.exists(path) and flag[0] not in "cn":
+            raise _FakeError(errno.ENOENT, "No such file or directory", path)
+
+        held = _LOCKS.get(path, 0)
+        if held < 0 or (self._writer and held > 0):
+            raise _FakeError(errno.EAGAIN, "Resource temporarily unavailable", path)
+        _LOCKS[path] = -1 if self._writer else held + 1
+
+        if os.path.exists(path) and flag[0] != "n":
+            with builtins.open(path, "rb") as f:
+                self._data = pickle.load(f)
+        else:
+            self._data = {}
+            self._flush()
+
+    def _flush(self):
+        with builtins.open(self._path, "wb") as f:
+            pickle.dump(self._data, f)
+
+    def get(self, key, default=None):
+        return self._data.get(key, default)
+
+    def __getitem__(self, key):
+        return self._data[key]
+
+    def __setitem__(self, key, value):
+        if not self._writer:
+            raise _FakeError("Reader can't store")
+        self._data[key] = bytes(value)
+
+    def __delitem__(self, key):
+        del self._data[key]
+
+    def firstkey(self):
+        return next(iter(self._data), None)
+
+    def nextkey(self, key):
+        keys = [*self._data]
+        i = keys.index(key) + 1
+        return keys[i] if i < len(keys) else None
+
+    def sync(self):
+        if self._writer:
+            self._flush()
+
+    reorganize = sync
+
+    def close(self):
+        if self._data is None:
+            return
+        self.sync()
+        self._data = None
+        held = _LOCKS.pop(self._path)
+        if held > 1:
+            _LOCKS[self._path] = held - 1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+try:
+    import dbm.gnu  # noqa: F401
+except ImportError:
+    _gdbm = types.ModuleType("_gdbm")
+    _gdbm.error = _FakeError
+    _gdbm.open = _FakeDb
+    _gdbm.open_flags = "rwcnfsu"
+    sys.modules["_gdbm"] = _gdbm
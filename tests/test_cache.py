@@ -0,0 +1,273 @@
+import asyncio
+from dbm import gnu as gdbm
+import pickle
+import threading
+import time
+
+import pytest
+
+from wkflws_dbm import cache
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    yield str(tmp_path / "test.dbm")
+    cache.close()
+    cache._READ_CACHE.clear()
+    cache._READ_CACHE_STAMPS.clear()
+
+
+class _GatedHandle:
+    """Wrap a gdbm handle so ``sync()`` fails and reads of ``b"gate"`` block."""
+
+    def __init__(self, db, entered: threading.Event, gate: threading.Event):
+        self._db = db
+        self._entered = entered
+        self._gate = gate
+
+    def __getattr__(self, name):
+        return getattr(self._db, name)
+
+    def __getitem__(self, key):
+        return self._db[key]
+
+    def __setitem__(self, key, value):
+        self._db[key] = value
+
+    def get(self, key, default=None):
+        if key == b"gate":
+            self._entered.set()
+            self._gate.wait(5)
+        return self._db.get(key, default)
+
+    def sync(self):
+        raise OSError("disk full")
+
+
+def test_round_trip(db_path):
+    async def main():
+        await cache.set(db_path, "a", {"x": [1, 2]})
+        return await cache.get(db_path, "a")
+
+    assert asyncio.run(main()) == {"x": [1, 2]}
+
+
+def test_missing_database_returns_default_without_worker(db_path):
+    async def main():
+        return await cache.get(db_path, "a", "default")
+
+    assert asyncio.run(main()) == "default"
+    assert db_path not in cache._WORKERS
+
+
+def test_raise_on_miss(db_path):
+    async def main():
+        await cache.set(db_path, "a", 1)
+        await cache.get(db_path, "b", raise_on_miss=True)
+
+    with pytest.raises(cache.CacheKeyNotFoundError):
+        asyncio.run(main())
+
+
+def test_expired_value_returns_default(db_path):
+    async def main():
+        await cache.set(db_path, "a", 1, expiry_secs=-1)
+        return await cache.get(db_path, "a", "default")
+
+    assert asyncio.run(main()) == "default"
+
+
+def test_float_expiry(db_path):
+    async def main():
+        await cache.set(db_path, "a", 1, expiry_secs=2.5)
+        return await cache.get(db_path, "a")
+
+    assert asyncio.run(main()) == 1
+
+
+def test_mutating_a_result_does_not_change_later_reads(db_path):
+    async def main():
+        await cache.set(db_path, "a", {"x": [1, 2]})
+        first = await cache.get(db_path, "a")
+        first["x"].append(99)
+        return await cache.get(db_path, "a")
+
+    assert asyncio.run(main()) == {"x": [1, 2]}
+
+
+def test_write_from_another_handle_is_seen(db_path):
+    async def main():
+        await cache.set(db_path, "a", 1)
+        assert await cache.get(db_path, "a") == 1
+        assert await cache.get(db_path, "a") == 1  # answered from memory
+
+        time.sleep(0.02)  # past the granularity of coarse file timestamps
+        with gdbm.open(db_path, "w") as db:
+            db[b"a"] = cache._HEADER.pack(cache._MAGIC, 0) + cache._ENCODER.encode(2)
+        return await cache.get(db_path, "a")
+
+    assert asyncio.run(main()) == 2
+
+
+def test_operations_run_in_submission_order(db_path):
+    async def main():
+        return await asyncio.gather(
+            cache.set(db_path, "k", 1),
+            cache.get(db_path, "k"),
+            cache.set(db_path, "k", 2),
+            cache.get(db_path, "k"),
+        )
+
+    assert asyncio.run(main()) == [None, 1, None, 2]
+
+
+def test_sync_failure_keeps_read_results(db_path, monkeypatch):
+    entered = threading.Event()
+    gate = threading.Event()
+
+    async def main():
+        await cache.set(db_path, "a", "A")
+
+        real_open = gdbm.open
+        monkeypatch.setattr(
+            cache.dbm,
+            "open",
+            lambda path, mode: _GatedHandle(real_open(path, mode), entered, gate),
+        )
+
+        # hold the worker inside a read so the write and read below share a batch
+        blocked = asyncio.ensure_future(cache.get(db_path, "gate"))
+        while not entered.is_set():
+            await asyncio.sleep(0.01)
+        write = asyncio.ensure_future(cache.set(db_path, "b", "B"))
+        read = asyncio.ensure_future(cache.get(db_path, "a"))
+        await asyncio.sleep(0.05)
+        gate.set()
+
+        assert await blocked is None
+        assert await read == "A"
+        with pytest.raises(cache.CacheError):
+            await write
+
+    asyncio.run(main())
+
+
+def test_handle_is_released_before_callers_resume(db_path):
+    def assert_unlocked():
+        # another writer can take the file lock only once the worker let go of it
+        with gdbm.open(db_path, "w"):
+            pass
+
+    async def main():
+        await cache.set(db_path, "a", 1)
+        assert_unlocked()
+        cache._READ_CACHE.clear()
+        assert await cache.get(db_path, "a") == 1
+        assert_unlocked()
+        await cache.clean(db_path)
+        assert_unlocked()
+        await asyncio.gather(cache.set(db_path, "b", 2), cache.get(db_path, "c"))
+        assert_unlocked()
+
+    asyncio.run(main())
+
+
+def test_idle_worker_retires(db_path, monkeypatch):
+    monkeypatch.setattr(cache, "_WORKER_IDLE_SECS", 0.05)
+
+    async def main():
+        await cache.set(db_path, "a", 1)
+        worker = cache._WORKERS[db_path]
+        worker._thread.join(1)
+        assert not worker._thread.is_alive()
+        assert db_path not in cache._WORKERS
+        cache._READ_CACHE.clear()
+        return await cache.get(db_path, "a")
+
+    assert asyncio.run(main()) == 1
+
+
+def test_close_then_reuse(db_path):
+    async def main():
+        await cache.set(db_path, "a", 1)
+        cache.close(db_path)
+        assert db_path not in cache._WORKERS
+        cache._READ_CACHE.clear()
+        return await cache.get(db_path, "a")
+
+    assert asyncio.run(main()) == 1
+
+
+def test_operations_behind_stop_are_rejected(db_path):
+    async def main():
+        await cache.set(db_path, "a", 1)
+        loop = asyncio.get_running_loop()
+        worker = cache._WORKERS.pop(db_path)
+
+        before, after = loop.create_future(), loop.create_future()
+        worker._queue.put(("get", (b"a",), loop, before))
+        worker._queue.put(None)
+        worker._queue.put(("get", (b"a",), loop, after))
+        worker._thread.join(1)
+
+        assert await before is not None
+        with pytest.raises(cache.CacheError):
+            await after
+
+    asyncio.run(main())
+
+
+def test_clean_removes_only_expired(db_path):
+    async def main():
+        for i in range(10):
+            await cache.set(db_path, f"k{i}", i, expiry_secs=-5 if i % 2 else 300)
+        await cache.clean(db_path)
+        return [await cache.get(db_path, f"k{i}") for i in range(10)]
+
+    assert asyncio.run(main()) == [0, None, 2, None, 4, None, 6, None, 8, None]
+
+
+def test_legacy_record_is_a_miss_and_cleaned(db_path):
+    # the pickled {"exp", "v"} records written before the record header existed
+    with gdbm.open(db_path, "c") as db:
+        db[b"old"] = pickle.dumps({"exp": 1, "v": "stale"})
+        db[b"short"] = b"x"
+
+    async def main():
+        await cache.set(db_path, "new", 1)
+        assert await cache.get(db_path, "old", "default") == "default"
+        with pytest.raises(cache.CacheKeyNotFoundError):
+            await cache.get(db_path, "short", raise_on_miss=True)
+        await cache.clean(db_path)
+
+    asyncio.run(main())
+    with gdbm.open(db_path, "r") as db:
+        assert db.get(b"old") is None
+        assert db.get(b"short") is None
+        assert db.get(b"new") is not None
+
+
+def test_event_loops_in_several_threads(db_path, monkeypatch):
+    monkeypatch.setattr(cache, "_READ_CACHE_SIZE", 8)
+    errors = []
+
+    async def churn(n):
+        for i in range(200):
+            key = f"k{(i + n) % 16}"
+            await cache.set(db_path, key, i)
+            await cache.get(db_path, key)
+            if i % 50 == 0:
+                await cache.clean(db_path)
+
+    def run(n):
+        try:
+            asyncio.run(churn(n))
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=run, args=(n,)) for n in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert errors == []
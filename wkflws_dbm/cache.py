@@ -1,20 +1,59 @@
-"""A dirty cache module using the standard library.
+"""A dirty cache module built on the standard library's dbm.
 
 This module aims to be a simple drop-in replacement for memcache style cache
 libraries. If your project grows to any significant size you should consider using a
 real cache stack.
 """
 import asyncio
+import atexit
+from collections import OrderedDict
 from dbm import gnu as dbm
+import errno
 import os
-import pickle
-from threading import Lock
-import time
+import queue
+import struct
+from threading import Lock, Thread
+from time import time as _time_time
 from typing import Any, Optional
 
-_WRITE_LOCK = Lock()
+import msgspec
 
-epoch = lambda: int(time.time())  # noqa
+# One worker thread per database path, each owning that database's handle. Workers
+# exit after sitting idle for _WORKER_IDLE_SECS so unused paths don't pin a thread.
+_WORKERS: dict[str, "_DbmWorker"] = {}
+_WORKERS_LOCK = Lock()
+_WORKER_IDLE_SECS = 5.0
+
+# Reused for every call so each (de)serialization doesn't allocate a new codec.
+_ENCODER = msgspec.msgpack.Encoder()
+_DECODER = msgspec.msgpack.Decoder()
+
+# Records are stored as _MAGIC and an 8 byte big-endian expiry timestamp followed by
+# the serialized value so the expiry can be read without deserializing. An expiry of
+# 0 never expires. Records without the magic were written by an older version of this
+# module; they're treated as misses and removed by clean().
+_MAGIC = b"\xff\x01"
+_HEADER = struct.Struct(">2sQ")
+_HEADER_SIZE = _HEADER.size
+
+# The most operations a worker takes off its queue at once. Writes within a batch
+# share a single sync.
+_WRITE_BATCH_SIZE = 512
+
+# Recently read records keyed by (db_path, key) and stored with their expiry. Hits
+# are still decoded on every read so callers never share (and can't mutate) each
+# other's objects. Other processes write to the same files, so every database's
+# records are dropped whenever its file's _stamp changes. Callers may run event
+# loops in several threads, so it's only touched while holding _READ_CACHE_LOCK.
+_READ_CACHE_SIZE = 4096
+_READ_CACHE_LOCK = Lock()
+_READ_CACHE: OrderedDict[tuple[str, bytes], tuple[int, bytes]] = OrderedDict()
+_READ_CACHE_STAMPS: dict[str, tuple[int, int, int]] = {}
+
+
+def epoch() -> int:
+    """Return the current Unix time in whole seconds."""
+    return int(_time_time())
 
 
 class CacheError(Exception):
@@ -29,12 +68,375 @@ class CacheKeyNotFoundError(CacheError):
     pass
 
 
+def _prefetch(db_path: str):
+    """Ask the kernel to start reading ``db_path`` into the page cache.
+
+    gdbm doesn't expose its file descriptor so a second one is opened just to give
+    the hint. ``POSIX_FADV_RANDOM`` isn't worth setting the same way since that
+    advice only applies to the descriptor it's given.
+    """
+    if not hasattr(os, "posix_fadvise"):  # e.g. macOS
+        return
+
+    try:
+        fd = os.open(db_path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        # a length of 0 means through the end of the file
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+    except OSError:
+        pass  # only a hint
+    finally:
+        os.close(fd)
+
+
+def _resolve(fut: asyncio.Future, result: Any, exc: Optional[Exception]):
+    """Complete ``fut`` unless the caller has already given up on it."""
+    if fut.done():
+        return
+    if exc is not None:
+        fut.set_exception(exc)
+    else:
+        fut.set_result(result)
+
+
+def _notify(loop: asyncio.AbstractEventLoop, fut: asyncio.Future, result, exc):
+    """Complete ``fut`` on ``loop`` from a worker thread."""
+    try:
+        loop.call_soon_threadsafe(_resolve, fut, result, exc)
+    except RuntimeError:  # the loop was closed while we were working
+        pass
+
+
+class _DbmWorker:
+    """A thread that owns the handle for a single database.
+
+    Every operation on the database is submitted to this thread rather than the
+    default executor so callers don't compete for pool threads, and the handle stays
+    open for as long as operations keep arriving. Whatever is queued when the thread
+    wakes is handled as one batch. Reads are answered as soon as they run; the writes
+    are synced once at the end of the batch before any of their callers resume.
+    """
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self._db: Any = None
+        self._mode = ""
+        self._prefetched = False
+        self._queue: queue.SimpleQueue = queue.SimpleQueue()
+        self._thread = Thread(target=self._run, name=f"dbm {db_path}", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Close the handle once everything already queued has been handled."""
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            try:
+                batch = [self._queue.get(timeout=_WORKER_IDLE_SECS)]
+            except queue.Empty:
+                if self._retire():
+                    return
+                continue
+
+            while len(batch) < _WRITE_BATCH_SIZE:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            stopping = None in batch
+            if stopping:
+                i = batch.index(None)
+                batch, late = batch[:i], batch[i:]
+
+            writes = []
+            last = None
+            for i, (op, args, loop, fut) in enumerate(batch, 1):
+                try:
+                    result, exc = getattr(self, f"_{op}")(*args), None
+                except Exception as e:
+                    result, exc = None, e
+
+                if op == "set" and exc is None:
+                    # held back until the sync below has made the write durable
+                    writes.append((loop, fut))
+                elif i == len(batch):
+                    last = (loop, fut, result, exc)
+                else:
+                    _notify(loop, fut, result, exc)
+
+            sync_error = None
+            if writes:
+                try:
+                    if self._db is not None:
+                        self._db.sync()
+                except Exception as e:
+                    sync_error = CacheError(f"Error writing data to cache: {e}")
+
+            if stopping or self._queue.empty():
+                # gdbm holds its file lock for as long as the handle is open, so let
+                # go of it between bursts for other processes using the database. It
+                # is released before the burst's callers resume so they can open the
+                # file themselves straight away.
+                self._close()
+
+            for loop, fut in writes:
+                _notify(loop, fut, None, sync_error)
+            if last is not None:
+                _notify(*last)
+
+            if stopping:
+                self._reject(late)
+                return
+
+    def _retire(self) -> bool:
+        """Stop serving the database if nothing has been queued since going idle."""
+        with _WORKERS_LOCK:
+            # close() may already have replaced us; its stop will arrive shortly
+            if _WORKERS.get(self.db_path) is not self or not self._queue.empty():
+                return False
+            del _WORKERS[self.db_path]
+        self._close()
+        return True
+
+    def _reject(self, late):
+        """Fail anything submitted after ``stop`` so its caller doesn't wait forever."""
+        while True:
+            try:
+                late.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+
+        for item in late:
+            if item is None:
+                continue
+            _, _, loop, fut = item
+            _notify(loop, fut, None, CacheError(f"Database was closed: {self.db_path}"))
+
+    def _open(self, mode: str):
+        """Return the handle, opening it in ``mode`` if needed.
+
+        gdbm won't allow a reader and a writer on the same file at once so a read-only
+        handle is reopened when a write mode is requested, and a handle opened for
+        writing also services reads.
+        """
+        if self._db is not None:
+            if mode.startswith("r") or not self._mode.startswith("r"):
+                return self._db
+            self._close()
+
+        self._db = dbm.open(self.db_path, mode)
+        self._mode = mode
+        if not self._prefetched:
+            # the handle is reopened for every burst; the pages only need warming once
+            _prefetch(self.db_path)
+            self._prefetched = True
+        return self._db
+
+    def _close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def _get(self, key: bytes) -> Optional[bytes]:
+        try:
+            # Read-only, fast mode (writes not synchronized but no writing is done)
+            db = self._open("rf")
+        except dbm.error as e:
+            if e.errno == errno.ENOENT:
+                # the database hasn't been written yet
+                return None
+            raise
+        return db.get(key)
+
+    def _set(self, key: bytes, serialized_value: bytes):
+        # create if it doesn't exist, fast mode since the batch is synced at once
+        try:
+            self._open("cf")[key] = serialized_value
+        except Exception as e:
+            raise CacheError(f"Error writing data to cache: {e}")
+
+    def _list(self, keys_only: bool, deserialize_func):
+        from pprint import pprint
+
+        # read only in fast mode
+        db = self._open("rf")
+        k = db.firstkey()
+        while k is not None:
+            if keys_only:
+                print(k)
+            else:
+                record = db[k]
+                exp = _expiry(record)
+                print(k)
+                if exp is None:
+                    pprint(record)  # from an older version, not ours to decode
+                else:
+                    pprint({"exp": exp, "v": deserialize_func(record[_HEADER_SIZE:])})
+
+            k = db.nextkey(k)
+
+    def _clean(self, older_than_ts: int, compact: bool):
+        # create if it doesn't exist, fast mode with an explicit sync once done
+        db = self._open("cf")
+        # gdbm's iteration order is undefined once keys are deleted so collect
+        # them all, with their headers, before removing anything
+        keys = []
+        headers = bytearray()
+        k = db.firstkey()
+        while k is not None:
+            keys.append(k)
+            # padded so a short record from an older version can't misalign the rest
+            headers += db[k][:_HEADER_SIZE].ljust(_HEADER_SIZE, b"\0")
+            k = db.nextkey(k)
+
+        for k, (magic, exp) in zip(keys, _HEADER.iter_unpack(headers)):
+            if magic != _MAGIC or (exp and older_than_ts > exp):
+                del db[k]
+
+        if compact:
+            db.reorganize()
+        db.sync()
+
+
+def _submit(db_path: str, op: str, *args) -> asyncio.Future:
+    """Queue ``op`` for the worker serving ``db_path``, starting one if needed.
+
+    The lookup and the enqueue happen under ``_WORKERS_LOCK`` so a worker can't
+    retire between being found and being handed the operation.
+    """
+    loop = asyncio.get_running_loop()
+    fut = loop.create_future()
+    with _WORKERS_LOCK:
+        worker = _WORKERS.get(db_path)
+        if worker is None:
+            worker = _WORKERS[db_path] = _DbmWorker(db_path)
+        worker._queue.put((op, args, loop, fut))
+    return fut
+
+
+def close(db_path: Optional[str] = None):
+    """Stop the workers serving databases, closing their handles.
+
+    Handles are already closed whenever a worker runs out of queued work, and idle
+    workers exit on their own. This is also run automatically at exit.
+
+    Args:
+        db_path: The full path of the database to close. *Default is all databases*
+    """
+    with _WORKERS_LOCK:
+        paths = [db_path] if db_path else [*_WORKERS]
+        workers = [_WORKERS.pop(path) for path in paths if path in _WORKERS]
+
+    for worker in workers:
+        worker.stop()
+
+
+atexit.register(close)
+
+
+def _stamp(db_path: str) -> Optional[tuple[int, int, int]]:
+    """Identify the current version of ``db_path``, or ``None`` if it doesn't exist.
+
+    Any write to the file moves its modification time. The size and inode are
+    included for filesystems with coarse timestamps and for files that are replaced.
+    """
+    try:
+        st = os.stat(db_path)
+    except OSError:
+        return None
+    return st.st_ino, st.st_size, st.st_mtime_ns
+
+
+def _cache_record(
+    db_path: str,
+    stamp: Optional[tuple[int, int, int]],
+    key: bytes,
+    exp: int,
+    record: bytes,
+):
+    """Remember a record read from ``db_path``, evicting the oldest on overflow.
+
+    ``stamp`` is the file's :func:`_stamp` from before the record was read. Nothing is
+    remembered if the file has been seen to change since.
+    """
+    with _READ_CACHE_LOCK:
+        if stamp is None or _READ_CACHE_STAMPS.get(db_path) != stamp:
+            return
+        _READ_CACHE[(db_path, key)] = (exp, record)
+        _READ_CACHE.move_to_end((db_path, key))
+        if len(_READ_CACHE) > _READ_CACHE_SIZE:
+            _READ_CACHE.popitem(last=False)
+
+
+def _remembered(
+    db_path: str, key: bytes, stamp: Optional[tuple[int, int, int]], now: int
+) -> Optional[bytes]:
+    """Return the unexpired record remembered for ``key``, if any.
+
+    Everything remembered for ``db_path`` is dropped first if ``stamp`` shows the
+    file was written since, perhaps by another process.
+    """
+    with _READ_CACHE_LOCK:
+        if _READ_CACHE_STAMPS.get(db_path) != stamp:
+            _drop_db(db_path)
+            if stamp is not None:
+                _READ_CACHE_STAMPS[db_path] = stamp
+            return None
+
+        entry = _READ_CACHE.get((db_path, key))
+        if entry is None:
+            return None
+        exp, record = entry
+        if exp and exp <= now:
+            del _READ_CACHE[(db_path, key)]
+            return None
+        _READ_CACHE.move_to_end((db_path, key))
+        return record
+
+
+def _expiry(record: bytes) -> Optional[int]:
+    """Return the expiry in ``record``'s header, or ``None`` if it doesn't have one."""
+    if len(record) < _HEADER_SIZE:
+        return None
+    magic, exp = _HEADER.unpack_from(record)
+    return exp if magic == _MAGIC else None
+
+
+def _decode(record: bytes, deserialize_func) -> Any:
+    """Deserialize the value stored in ``record``."""
+    if deserialize_func == _DECODER.decode:
+        # msgspec decodes straight from a view, skipping a copy of the record body
+        return deserialize_func(memoryview(record)[_HEADER_SIZE:])
+    return deserialize_func(record[_HEADER_SIZE:])
+
+
+def _drop_db(db_path: str):
+    """Drop every record remembered for ``db_path``. ``_READ_CACHE_LOCK`` is held."""
+    _READ_CACHE_STAMPS.pop(db_path, None)
+    for cache_key in [k for k in _READ_CACHE if k[0] == db_path]:
+        del _READ_CACHE[cache_key]
+
+
+def _forget(db_path: str, key: Optional[bytes] = None):
+    """Drop the record remembered for ``key``, or for every key if not given."""
+    with _READ_CACHE_LOCK:
+        if key is None:
+            _drop_db(db_path)
+        else:
+            _READ_CACHE.pop((db_path, key), None)
+
+
 async def get(
     db_path: str,
     key: str,
     default: Optional[Any] = None,
     raise_on_miss: bool = False,
-    deserialize_func=pickle.loads,
+    deserialize_func=_DECODER.decode,
 ) -> Any:
     """Retrieve the value stored under ``key`` from the cache.
 
@@ -43,11 +445,16 @@ async def get(
         key: The key the value is stored under.
         default: The default value to return if key is not found.
         raise_on_miss: Raise an exception on error instead of returning default. The
-            cache serializes Python objects so it's entirely possible to retrieve an
-            object that matches the default value and assume it was a miss.
+            cache stores serialized values so it's entirely possible to retrieve a
+            value that matches the default value and assume it was a miss.
         deserialize_func: The function to use when deserializing the cached
             value. This function must accept bytes as it's only input.
-            *Default is pickle.loads*
+            *Default is msgpack decoding*
+
+    .. note::
+
+       With the default msgpack serialization only msgpack compatible types round
+       trip. Tuples come back as lists, and arbitrary objects can't be stored at all.
 
     Raises:
         CacheKeyNotFoundError: is raised if there is a cache miss and ``raise_on_miss``
@@ -55,29 +462,36 @@ async def get(
 
     Returns: The cached object or ``default``
     """
-
-    def read_value(_k: str) -> Optional[Any]:
-        if not os.path.exists(db_path):
-            return None
-        # Read-only, fast mode (writes not synchronized but no writing is done)
-        with dbm.open(db_path, "rf") as db:
-            return db.get(_k)
-
-    loop = asyncio.get_event_loop()
-
-    value = await loop.run_in_executor(None, read_value, key)
-
-    if value is None and raise_on_miss:
+    # encoded once here rather than by gdbm on every lookup
+    _kb = key.encode("utf-8") if isinstance(key, str) else key
+
+    now = int(_time_time())
+    # taken before reading so a write that lands in between is noticed next time
+    stamp = _stamp(db_path)
+    record = _remembered(db_path, _kb, stamp, now)
+    if record is not None:
+        return _decode(record, deserialize_func)
+
+    # a database that was never written can't hold the key, so don't start a worker
+    # to find that out. Once a worker is serving the path it handles this itself.
+    if db_path not in _WORKERS and stamp is None:
+        value = None
+    else:
+        value = await _submit(db_path, "get", _kb)
+
+    # a record written by an older version of this module is as good as a miss
+    exp = None if value is None else _expiry(value)
+    if exp is None and raise_on_miss:
         raise CacheKeyNotFoundError(f"Key not found in cache: {key}")
-    elif value is None:
+    elif exp is None:
         return default
 
-    payload = deserialize_func(value)
-
-    if payload.get("exp", 0) and epoch() >= payload["exp"]:
+    if exp and exp <= now:
         return default
 
-    return payload["v"] if "v" in payload else payload
+    v = _decode(value, deserialize_func)
+    _cache_record(db_path, stamp, _kb, exp, value)
+    return v
 
 
 async def set(
@@ -85,13 +499,15 @@ async def set(
     key: str,
     value: Any,
     expiry_secs: int = 300,
-    serialize_func=pickle.dumps,
+    serialize_func=_ENCODER.encode,
 ):
     """Set a value in the cache stored under ``key``.
 
     .. note::
 
-       This function uses a lock to prevent multiple writers.
+       Writes are handed to the database's worker thread which commits everything
+       queued at that moment as one group. This function returns once the group
+       containing ``value`` has been synced to disk.
 
     Args:
         db_path: The full path of the database to read.
@@ -100,35 +516,30 @@ async def set(
         expiry_secs: The number of seconds the value is valid for.
         serialize_func: The function to use to serialize ``value`` before storing in the
             cache. This function must accept any object as it's only input and return
-            bytes. *Default is pickle.dumps*
+            bytes. *Default is msgpack encoding*
 
     Raises:
         CacheError: There was an error while storing the value.
     """
-
-    def write_value(_v):
-        # create if it doesn't exist, sync mode to write immediately
-        with dbm.open(db_path, "cs") as db:
-            try:
-                db[key] = _v
-            except Exception as e:
-                raise CacheError(f"Error writing data to cache: {e}")
-
-    loop = asyncio.get_event_loop()
     try:
-        payload = {
-            "exp": epoch() + expiry_secs,
-            "v": value,
-        }
-        serialized_value = serialize_func(payload)
+        exp = int(_time_time()) + int(expiry_secs)
+        serialized_value = _HEADER.pack(_MAGIC, exp) + serialize_func(value)
     except Exception as e:
         raise CacheError(f"Error serializing object: {e}")
 
-    with _WRITE_LOCK:
-        await loop.run_in_executor(None, write_value, serialized_value)
+    # encoded once here rather than by gdbm on every write
+    _kb = key.encode("utf-8") if isinstance(key, str) else key
+
+    _forget(db_path, _kb)
 
+    await _submit(db_path, "set", _kb, serialized_value)
 
-async def list(db_path: str, keys_only: bool = False, deserialize_func=pickle.loads):
+    # a read that started before the write committed may have remembered the old
+    # value in the meantime
+    _forget(db_path, _kb)
+
+
+async def list(db_path: str, keys_only: bool = False, deserialize_func=_DECODER.decode):
     """Pretty print out the contents of the cache.
 
     Args:
@@ -136,37 +547,23 @@ async def list(db_path: str, keys_only: bool = False, deserialize_func=pickle.lo
         keys_only: Don't deserialize and display the raw values.
         deserialize_func: The function to use when deserializing the cached
             value. This function must accept bytes as it's only input.
-            *Default is pickle.loads*
+            *Default is msgpack decoding*
 
     """
-    from pprint import pprint
-
-    def list_db():
-        # read only in fast mode
-        with dbm.open(db_path, "rf") as db:
-            k = db.firstkey()
-            while k is not None:
-                if keys_only:
-                    print(k)
-                else:
-                    v = deserialize_func(db[k])
-                    print(k)
-                    pprint(v)
-
-                k = db.nextkey(k)
-
-    loop = asyncio.get_event_loop()
-    await loop.run_in_executor(None, list_db)
+    await _submit(db_path, "list", keys_only, deserialize_func)
 
 
 async def clean(
     db_path: str,
     older_than_ts: int = None,
     compact: bool = False,
-    deserialize_func=pickle.loads,
+    deserialize_func=_DECODER.decode,
 ):
     """Clean the cache of expired values.
 
+    Records written by older versions of this module, which can't be read, are also
+    removed.
+
     I believe there is a global lock on the actual database so in theory this should be
     safe to run in a separate process. The GNU dbm should prevent any accidents.
 
@@ -177,26 +574,11 @@ async def clean(
         compact: Also compact the database. This essentially defrags the database so it
             should help reclaim space and improve seek speed after many records have
             been removed. *Default is False*
-        deserialize_func: The function to use when deserializing the cached
-            value. This function must accept bytes as it's only input. Used to compare
-            expiration. *Default is pickle.loads*
+        deserialize_func: Unused. Expiration is read from the record header without
+            deserializing the value. Kept for backwards compatibility.
     """
     if not older_than_ts:
-        older_than_ts = epoch()
-
-    def clean_db():
-        # create if it doesn't exist, sync mode to write immediately
-        with dbm.open(db_path, "cs") as db:
-            k = db.firstkey()
-            while k is not None:
-                v = deserialize_func(db[k])
-                if v.get("exp", 0) and older_than_ts > v["exp"]:
-                    del db[k]
-                k = db.nextkey(k)
-
-            if compact:
-                db.reorganize()
-
-    loop = asyncio.get_event_loop()
-    with _WRITE_LOCK:
-        await loop.run_in_executor(None, clean_db)
+        older_than_ts = int(_time_time())
+
+    await _submit(db_path, "clean", older_than_ts, compact)
+    _forget(db_path)
@@ -1,5 +1,4 @@
 import json
-import os
 from typing import Any
 
 from . import cache
@@ -15,7 +14,7 @@ async def set(message: dict[str, Any], context: dict[str, Any]) -> dict[str, Any
     if "/" in filename or "\\" in filename or "." in filename:
         raise ValueError("'file must not contain '/', '\\', '.'.")
 
-    db_path = os.path.join("/tmp", f"{filename}.dbm")
+    db_path = f"/tmp/{filename}.dbm"
 
     try:
         key: str = message["key"]